@@ -6,31 +6,61 @@ shanoir2bids.py is a script that allows to download a Shanoir dataset and organi
 # Script to download and BIDS-like organize data on Shanoir using "shanoir_downloader.py" developed by Arthur Masson
 
 
+import copy
+import io
 import os
 from os.path import join as opj, splitext as ops, exists as ope, dirname as opd
 import re
-from glob import glob
+import fnmatch
 import sys
 from pathlib import Path
 from time import time
 import zipfile
 import datetime
+import hashlib
 import tempfile
 from dateutil import parser
 import json
 import logging
+import mmap
+import multiprocessing
+import pickle
+import queue
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import shanoir_downloader
 from dotenv import load_dotenv
-from heudiconv.main import workflow
-from heudiconv.bids import sanitize_label
+from heudiconv.bids import BIDSFile, sanitize_label
 
 import bids_validator
 
 # Load environment variables
 load_dotenv(dotenv_path=opj(opd(__file__), ".env"))
 
+# orjson is optional, it is used when installed to decode the Solr responses and the configuration file faster
+try:
+    import orjson
+
+    def json_loads(content):
+        return orjson.loads(content)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+except ImportError:
+
+    def json_loads(content):
+        return json.loads(content)
+
+    def json_dumps(obj):
+        return json.dumps(obj, indent=4)
+
 
 def banner_msg(msg):
     """
@@ -57,6 +87,7 @@ K_JSON_DATE_FROM = (
 K_JSON_DATE_TO = (
     "date_to"  # examinationDate:[2014-03-21T00:00:00Z TO 2014-03-22T00:00:00Z]
 )
+SOLR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 LIST_MANDATORY_KEYS_JSON = [K_JSON_STUDY_NAME, K_JSON_L_SUBJECTS, K_JSON_DATA_DICT]
 LIST_AUTHORIZED_KEYS_JSON = LIST_MANDATORY_KEYS_JSON + [
     K_DCM2NIIX_PATH,
@@ -85,6 +116,10 @@ DCM = ".dcm"
 SHANOIR_FILE_TYPE_NIFTI = "nifti"
 SHANOIR_FILE_TYPE_DICOM = "dicom"
 DEFAULT_SHANOIR_FILE_TYPE = SHANOIR_FILE_TYPE_NIFTI
+DEFAULT_N_WORKERS = 4  # Number of subjects downloaded concurrently
+ZIP_COPY_BUFFER_SIZE = 1 << 20  # Size of the buffer used to extract the archives
+HTTP_POOL_MAXSIZE = 32  # Connections kept open to the Shanoir server (at least 2 per worker)
+HEUDICONV_WORKER_POLL_TIMEOUT = 5  # Seconds between two checks that the heudiconv worker is still alive
 
 # Define error and warning messages when call to dcm2niix is not well configured in the json file
 DCM2NIIX_ERR_MSG = """ERROR !!
@@ -103,15 +138,134 @@ def create_tmp_directory(path_temporary_directory):
     pass
 
 
+class MappedArchive(mmap.mmap):
+    """
+    Read-only memory map of an archive file, that zipfile can read as a seekable file object
+    """
+
+    def seekable(self):
+        return True
+
+
+def sanitize_member_name(member_name):
+    """
+    Relative path of an archive member, as zipfile.extractall computes it: drive letters, absolute paths,
+    "." and ".." components are removed
+    :param member_name: str, name of the member in the zip archive
+    :return: str, path of the member relative to the extraction directory
+    """
+    arcname = member_name.replace("/", os.sep)
+    if os.altsep:
+        arcname = arcname.replace(os.altsep, os.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ("", os.curdir, os.pardir)
+    return os.sep.join(x for x in arcname.split(os.sep) if x not in invalid_path_parts)
+
+
+def extract_archive(path_archive, extraction_dir):
+    """
+    Extract all the members of a zip archive as zipfile.extractall, each file being streamed to disk with a
+    large copy buffer. The archive is memory-mapped, its members are read from the page cache without read
+    system calls.
+    :param path_archive: str, path to the zip archive
+    :param extraction_dir: str, directory where the files are extracted
+    :return: list of str, paths of the extracted files
+    """
+    extraction_dir = os.path.normpath(extraction_dir)
+    extraction_dir_sep = extraction_dir + os.sep
+    extracted_files = []
+    created_dirs = set()
+    with open(path_archive, "rb") as archive_file:
+        # an empty file can not be memory-mapped
+        if os.fstat(archive_file.fileno()).st_size == 0:
+            raise zipfile.BadZipFile("Empty archive " + path_archive)
+        with MappedArchive(archive_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_archive:
+            try:
+                zip_ref = zipfile.ZipFile(mapped_archive, "r")
+            except ValueError as e:
+                # mmap.seek raises ValueError where a file raises the OSError that zipfile reports as BadZipFile
+                raise zipfile.BadZipFile("File is not a zip file: " + path_archive) from e
+            with zip_ref:
+                for member in zip_ref.infolist():
+                    arcname = sanitize_member_name(member.filename)
+                    target = os.path.normpath(extraction_dir_sep + arcname)
+                    # Never write outside of the extraction directory
+                    if target != extraction_dir and not target.startswith(extraction_dir_sep):
+                        continue
+                    if member.is_dir():
+                        if target not in created_dirs:
+                            os.makedirs(target, exist_ok=True)
+                            created_dirs.add(target)
+                        continue
+                    target_dir = opd(target)
+                    if target_dir not in created_dirs:
+                        os.makedirs(target_dir, exist_ok=True)
+                        created_dirs.add(target_dir)
+                    with zip_ref.open(member) as src, open(target, "wb") as dst:
+                        shutil.copyfileobj(src, dst, length=ZIP_COPY_BUFFER_SIZE)
+                    extracted_files.append(target)
+    return extracted_files
+
+
+def extract_archives(archives, executor):
+    """
+    Extract several zip archives in parallel. zlib releases the GIL while inflating, so the archives
+    are extracted by the threads of an executor shared by all the subjects.
+    :param archives: list of (path to the zip archive, extraction directory) tuples
+    :param executor: concurrent.futures.Executor, executor running the extractions
+    :return: list of list of str, paths of the extracted files of each archive
+    """
+    futures = [executor.submit(extract_archive, *archive) for archive in archives]
+    return [future.result() for future in futures]
+
+
 def check_date_format(date_to_format):
     # TRUE FORMAT should be: date_format = 'Y-m-dTH:M:SZ'
     try:
-        parser.parse(date_to_format)
-    # If the date validation goes wrong
+        datetime.datetime.strptime(date_to_format, SOLR_DATE_FORMAT)
     except ValueError:
-        print(
-            "Incorrect data format, should be YYYY-MM-DDTHH:MM:SSZ (for example: 2020-02-19T00:00:00Z)"
-        )
+        # Not the expected format, check whether it is a date at all
+        try:
+            parser.parse(date_to_format)
+        # If the date validation goes wrong
+        except ValueError:
+            print(
+                "Incorrect data format, should be YYYY-MM-DDTHH:MM:SSZ (for example: 2020-02-19T00:00:00Z)"
+            )
+
+
+# List of Solr special characters
+# \* is not part of them to be able to use wildcards in solr
+# Add more if needed
+SOLR_SPECIAL_CHARACTERS = r'\+\-\!\(\)\{\}\[\]\^"~\?:\\'
+SOLR_ESCAPE_PATTERN = re.compile(r'([{}])'.format(SOLR_SPECIAL_CHARACTERS))
+
+
+def escape_solr_special_characters(s):
+    return SOLR_ESCAPE_PATTERN.sub(r'\\\1', s)
+
+
+def match_dataset_name(dataset_name, shanoir_seq_name):
+    """
+    Check whether the name of a dataset found on Shanoir matches a dataset name of the configuration file,
+    with the rules of the Solr search text: * is a wildcard, spaces are replaced by the ? wildcard (any
+    single character) and the other characters, escaped, are literal. As in Solr, case is insensitive.
+    :param dataset_name: str, name of the dataset returned by Shanoir
+    :param shanoir_seq_name: str, dataset name of the configuration file
+    :return: bool
+    """
+    pattern = ""
+    for c in shanoir_seq_name.lower():
+        if c == "*":
+            pattern += "*"
+        elif c == " ":
+            pattern += "?"
+        elif c in "?[":
+            # literal character for fnmatch
+            pattern += "[" + c + "]"
+        else:
+            pattern += c
+    return fnmatch.fnmatchcase(dataset_name.lower(), pattern)
 
 
 def read_json_config_file(json_file):
@@ -122,7 +276,7 @@ def read_json_config_file(json_file):
     :return:
     """
     f = open(json_file)
-    data = json.load(f)
+    data = json_loads(f.read())
     # Check keys
     for key in data.keys():
         if not key in LIST_AUTHORIZED_KEYS_JSON:
@@ -180,12 +334,41 @@ def read_json_config_file(json_file):
     )
 
 
+def get_bids_file_suffix(bids_name):
+    """
+    Insert a run key in a BIDS name to dissociate identical scans, unless it already contains one
+    :param bids_name: str, BIDS name of the sequence (eg: "T1w", "acq-b0_dir-AP_dwi", ...)
+    :return: str, file suffix of the heudiconv key
+    """
+    # check if run key is already used in filename
+    # (could be done in Pybids or using heudiconv utils?)
+    if "_run-" in bids_name:
+        return bids_name
+    bids_entities = BIDSFile._known_entities
+    # check where to insert run key
+    split_keyword = "_"  # default
+    for entity in bids_entities[bids_entities.index("run") + 1 :]:
+        if entity in bids_name:
+            split_keyword = "_" + entity
+            break
+    split_filename = bids_name.split(split_keyword)
+    if split_keyword != "_":
+        file_suffix = "".join(split_filename[:-1]) + "_" + "run-{item:02d}" + split_keyword + split_filename[-1]
+    else:
+        file_suffix = "_".join(split_filename[:-1]) + "_" + "run-{item:02d}" + split_keyword + split_filename[-1]
+        if len(split_filename) == 1:
+            # remove unwanted first "_"
+            file_suffix = file_suffix[1:]
+    return file_suffix
+
+
 def generate_bids_heuristic_file(
     shanoir2bids_dict,
     path_heuristic_file,
     output_type='("dicom","nii.gz")',
 ) -> None:
     """Generate heudiconv heuristic.py file from shanoir2bids mapping dict
+    The heudiconv key of each dataset is resolved here and written as a literal in the heuristic
     Parameters
     ----------
     shanoir2bids_dict :
@@ -198,72 +381,39 @@ def generate_bids_heuristic_file(
     else:
         outtype = '("dicom","nii.gz")'
 
-    heuristic = f"""from heudiconv.heuristics.reproin import create_key
-
-
-def create_bids_key(dataset):
-
-    from heudiconv.bids import BIDSFile 
-    
-    # check if run key is already used in filename 
-    # (could be done in Pybids or using heudiconv utils?) 
-    
-    if not '_run-' in  dataset['bidsName']:
-        bids_entities = BIDSFile._known_entities 
-        # insert additional run key to dissociate identical scans
-        # check where to insert run key 
-        split_keyword = '_' # default
-        for entity in bids_entities[bids_entities.index('run') + 1 :]:
-            if entity in dataset['bidsName']:
-                split_keyword = '_' + entity
-                break 
-        split_filename = dataset['bidsName'].split(split_keyword)
-        if split_keyword != '_':
-            file_suffix = "".join(split_filename[:-1]) + '_' +  r"run-{{item:02d}}" +  split_keyword  +  split_filename[-1]
-        else:
-      
-            file_suffix = "_".join(split_filename[:-1]) + '_' + r"run-{{item:02d}}" + split_keyword + split_filename[-1]
-            if len(split_filename) == 1:
-                # remove unwanted first "_" 
-                file_suffix = file_suffix[1:]
-    else:
-        file_suffix = dataset['bidsName']
-    template = create_key(subdir=dataset['bidsDir'],file_suffix=file_suffix,outtype={outtype})
-    return template
+    dataset_to_key = "".join(
+        f"    {dataset[K_DS_NAME]!r}: create_key(subdir={dataset[K_BIDS_DIR]!r}, "
+        f"file_suffix={get_bids_file_suffix(dataset[K_BIDS_NAME])!r}, outtype={outtype}),\n"
+        for dataset in shanoir2bids_dict
+    )
+
+    heuristic = f"""from collections import defaultdict
+
+from heudiconv.heuristics.reproin import create_key
 
-def get_dataset_to_key_mapping(shanoir2bids):
-    dataset_to_key = dict()
-    for dataset in shanoir2bids:
-        template = create_bids_key(dataset)
-        dataset_to_key[dataset['datasetName']] = template
-    return dataset_to_key
+
+dataset_to_key = {{
+{dataset_to_key}}}
 
 def simplify_runs(info):
     info_final = dict()
-    for key in info.keys():
+    for key, series_ids in info.items():
         print(key)
-        if len(info[key])==1:
+        if len(series_ids)==1:
             print('Simplified key', key)
             new_template = key[0].replace('run-{{item:02d}}_','')
             new_key = (new_template, key[1], key[2])
-            info_final[new_key] = info[key]
+            info_final[new_key] = series_ids
         else:
-            info_final[key] = info[key]
+            info_final[key] = series_ids
     return info_final
 
 def infotodict(seqinfo):
 
-    info = dict()
-    shanoir2bids = {shanoir2bids_dict}
-
-    dataset_to_key = get_dataset_to_key_mapping(shanoir2bids)
+    info = defaultdict(list)
     for seq in seqinfo:
-        if seq.series_description in dataset_to_key.keys():
-            key = dataset_to_key[seq.series_description]
-            if key in info.keys():
-                info[key].append(seq.series_id)
-            else:
-                info[key] = [seq.series_id]
+        if seq.series_description in dataset_to_key:
+            info[dataset_to_key[seq.series_description]].append(seq.series_id)
     # remove run- key if not needed (one run only)
     info_final = simplify_runs(info)      
     return info_final
@@ -274,6 +424,75 @@ def infotodict(seqinfo):
     pass
 
 
+def run_heudiconv_worker(params_queue, results_queue):
+    """
+    Run heudiconv conversions in a persistent process until None is received
+    :param params_queue: multiprocessing.Queue, parameters of the heudiconv workflow of each conversion
+    :param results_queue: multiprocessing.Queue, None for each successful conversion, the raised exception otherwise
+    """
+    from heudiconv.main import workflow
+
+    for workflow_params in iter(params_queue.get, None):
+        try:
+            workflow(**workflow_params)
+            results_queue.put(None)
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(repr(e))
+            results_queue.put(e)
+
+
+class HeudiconvWorker:
+    """
+    Persistent process running the heudiconv conversions one at a time. heudiconv and its dependencies are
+    imported once for all the subjects, and conversions do not run concurrently in the shared BIDS directory.
+    """
+
+    def __init__(self):
+        self._params_queue = multiprocessing.Queue()
+        self._results_queue = multiprocessing.Queue()
+        self._lock = threading.Lock()
+        self._process = multiprocessing.Process(
+            target=run_heudiconv_worker,
+            args=(self._params_queue, self._results_queue),
+        )
+
+    def start(self):
+        self._process.start()
+
+    def check_alive(self):
+        """
+        Raise a RuntimeError if the worker process exited, e.g. on SystemExit or KeyboardInterrupt in heudiconv
+        """
+        if not self._process.is_alive():
+            raise RuntimeError(
+                "heudiconv worker exited with code {}".format(self._process.exitcode)
+            )
+
+    def run(self, workflow_params):
+        """
+        Run a heudiconv conversion in the worker process and wait for its end
+        :param workflow_params: dict, parameters of heudiconv.main.workflow
+        """
+        with self._lock:
+            self.check_alive()
+            self._params_queue.put(workflow_params)
+            while True:
+                try:
+                    error = self._results_queue.get(timeout=HEUDICONV_WORKER_POLL_TIMEOUT)
+                    break
+                except queue.Empty:
+                    self.check_alive()
+        if error is not None:
+            raise error
+
+    def stop(self):
+        self._params_queue.put(None)
+        self._process.join()
+
+
 class DownloadShanoirDatasetToBIDS:
     """
     class that handles the downloading of shanoir data set and the reformatting as a BIDS data structure
@@ -298,6 +517,8 @@ class DownloadShanoirDatasetToBIDS:
         self.list_fars = []  # List of substrings to edit in subjects names
         self.dl_dir = None  # download directory, where data will be stored
         self.parser = None  # Shanoir Downloader Parser
+        self.parser_args = None  # Shanoir Downloader arguments shared by all the searches
+        self._session = None  # HTTP session shared by all the requests to Shanoir
         self.n_seq = 0  # Number of sequences in the shanoir2bids_dict
         self.log_fn = None
         self.dcm2niix_path = None  # Path to the dcm2niix the user wants to use
@@ -312,6 +533,19 @@ class DownloadShanoirDatasetToBIDS:
         self.add_sns = False  # Add series number suffix to filename
         self.debug_mode = False  # No debug mode by default
         self.datalad = True     # Activate datalad save by default
+        self.n_workers = DEFAULT_N_WORKERS  # Number of concurrent downloads
+        self._log_lock = threading.Lock()  # Serialize writes of the subjects to the log file
+        self._heudiconv_worker = None  # Process running the heudiconv conversions during the download
+        self._extract_executor = None  # Threads extracting the archives of all the subjects during the download
+        self._heuristic_dir = None  # Directory of the heuristic files generated during the download
+        self._heuristic_files = {}  # Heuristic files by digest of their BIDS mapping
+        self._heuristic_lock = threading.Lock()
+        self._search_txt_head = None  # Solr search text before the subject name
+        self._search_txt_tail = None  # Solr search text after the subject name
+        self._ds_names = []  # Shanoir sequence names of the data dictionary
+        self._bids_dirs = []  # BIDS subdirectories of the sequences
+        self._bids_names = []  # BIDS names of the sequences
+        self._ds_names_clean = []  # Shanoir sequence names as used in the Solr search text
 
     def set_json_config_file(self, json_file):
         """
@@ -371,7 +605,7 @@ class DownloadShanoirDatasetToBIDS:
 
     def export_dcm2niix_config_options(self, path_dcm2niix_options_file):
         # Serializing json
-        json_object = json.dumps(self.dcm2niix_opts, indent=4)
+        json_object = json_dumps(self.dcm2niix_opts)
         with open(path_dcm2niix_options_file, "w") as file:
             file.write(json_object)
 
@@ -384,6 +618,14 @@ class DownloadShanoirDatasetToBIDS:
     def set_shanoir2bids_dict(self, data_dict):
         self.shanoir2bids_dict = data_dict
         self.n_seq = len(self.shanoir2bids_dict)
+        # Fields of the sequences as parallel lists, iterated for every subject
+        self._ds_names = [d[K_DS_NAME] for d in data_dict]  # Shanoir sequence names (OLD)
+        self._bids_dirs = [d[K_BIDS_DIR] for d in data_dict]  # Sequence BIDS subdirectory names (NEW)
+        self._bids_names = [d[K_BIDS_NAME] for d in data_dict]  # Sequence BIDS nicknames (NEW)
+        # Sequence names as used in the Solr search text
+        self._ds_names_clean = [
+            escape_solr_special_characters(n).replace(" ", "?") for n in self._ds_names
+        ]
 
     def set_download_directory(self, dl_dir):
         if dl_dir is None:
@@ -404,20 +646,26 @@ class DownloadShanoirDatasetToBIDS:
         self.set_log_filename()
 
     def set_log_filename(self):
-        curr_time = datetime.datetime.now()
-        basename = "shanoir_downloader_{:04}{:02}{:02}_{:02}{:02}{:02}.log".format(
-            curr_time.year,
-            curr_time.month,
-            curr_time.day,
-            curr_time.hour,
-            curr_time.minute,
-            curr_time.second,
-        )
+        basename = datetime.datetime.now().strftime("shanoir_downloader_%Y%m%d_%H%M%S.log")
         dir_log = opj(self.dl_dir, 'shanoir_downloader_logs')
         if not ope(dir_log):
             Path(dir_log).mkdir(parents=True, exist_ok=True)
         self.log_fn = opj(self.dl_dir, 'shanoir_downloader_logs', basename)
 
+    def set_n_workers(self, n_workers):
+        if n_workers < 1:
+            sys.exit("Number of workers must be at least 1, got {}".format(n_workers))
+        self.n_workers = n_workers
+
+    def write_log(self, msg):
+        """
+        Append a message to the log file, safe to call from several download threads
+        :param msg: str, message to append
+        """
+        with self._log_lock:
+            with open(self.log_fn, "a") as fp:
+                fp.write(msg)
+
     def toggle_longitudinal_version(self):
         self.longitudinal = True
 
@@ -433,6 +681,15 @@ class DownloadShanoirDatasetToBIDS:
         """
         Configure the parser and the configuration of the shanoir_downloader
         """
+        # HTTP session shared by all the requests to reuse connections (one TLS handshake per connection)
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_maxsize=max(HTTP_POOL_MAXSIZE, 2 * self.n_workers),
+                max_retries=Retry(total=3, backoff_factor=0.3),
+            ),
+        )
         self.parser = shanoir_downloader.create_arg_parser()
         shanoir_downloader.add_username_argument(self.parser)
         shanoir_downloader.add_domain_argument(self.parser)
@@ -447,6 +704,38 @@ class DownloadShanoirDatasetToBIDS:
         shanoir_downloader.add_configuration_arguments(self.parser)
         shanoir_downloader.add_search_arguments(self.parser)
         shanoir_downloader.add_ids_arguments(self.parser)
+        # Arguments common to all the searches, the search text and output folder are set for each subject
+        self.parser_args = self.parser.parse_args(
+            [
+                "-u",
+                self.shanoir_username,
+                "-d",
+                self.shanoir_domaine,
+                "-of",
+                self.dl_dir,
+                "-em",
+                "-s",
+                str(200 * self.n_seq),  # 200 results per sequence per page, the next pages are fetched if needed
+                "-f",
+                self.shanoir_file_type,
+                "-so",
+                "id,ASC",
+                "-t",
+                "500",
+            ]
+        )  # Increase time out for heavy files
+
+    def set_search_text_template(self):
+        """
+        Precompute the parts of the Solr search text that are the same for all the subjects
+        """
+        study_q = escape_solr_special_characters(self.shanoir_study_id).replace(" ", "?")
+        session_q = escape_solr_special_characters(self.shanoir_session_id).replace(" ", "*")
+        # One disjunctive clause on the dataset names instead of one request per sequence
+        names_q = " OR ".join(self._ds_names_clean)
+        date_q = f"examinationDate:[{self.date_from} TO {self.date_to}]"
+        self._search_txt_head = f"studyName:{study_q} AND datasetName:({names_q}) AND subjectName:"
+        self._search_txt_tail = f" AND examinationComment:{session_q} AND {date_q}"
 
     def is_mapping_bids(self):
         """Check BIDS compliance of filenames/path used in the configuration file"""
@@ -521,6 +810,49 @@ class DownloadShanoirDatasetToBIDS:
         else:
             return False, bids_errors
 
+    def search_and_download_subject(self, subject_to_search, tmp_archive):
+        """
+        Search all the sequences of the dictionary on Shanoir for a single subject with one Solr request
+        and download the found datasets
+        :param subject_to_search: str, Shanoir subject name
+        :param tmp_archive: Path, directory where the archives are downloaded
+        :return: the Solr search text, the response of the request, the found datasets and the paths of the
+        downloaded archives by dataset id
+        """
+        subject_q = escape_solr_special_characters(subject_to_search).replace(" ", "?")
+        search_txt = f"{self._search_txt_head}{subject_q}{self._search_txt_tail}"
+
+        print(search_txt)
+
+        # Only the search text and the output folder change from one subject to another
+        args = copy.copy(self.parser_args)
+        args.search_text = search_txt
+        args.output_folder = str(tmp_archive)
+
+        config = shanoir_downloader.initialize(args, session=self._session)
+        response = shanoir_downloader.solr_search(config, args)
+
+        search_results = []
+        dl_archives = {}
+        if response.status_code == 200:
+            # Decode the response once, it is used both to download and to process the data
+            page = json_loads(response.content)
+            search_results = page["content"]
+            # The sequences share the result pages, fetch all of them so that no sequence is truncated
+            while not page.get("last", True) and page["content"]:
+                args.page = int(args.page) + 1
+                page_response = shanoir_downloader.solr_search(config, args)
+                if page_response.status_code != 200:
+                    break
+                page = json_loads(page_response.content)
+                search_results.extend(page["content"])
+            # Invoke shanoir_downloader to download all the data
+            dl_archives = shanoir_downloader.download_search_results(
+                config, args, response, json_content=search_results
+            )
+
+        return search_txt, response, search_results, dl_archives
+
     def download_subject(self, subject_to_search):
         """
         For a single subject
@@ -529,13 +861,18 @@ class DownloadShanoirDatasetToBIDS:
         :param subject_to_search:
         :return:
         """
+        # Do not download a subject that could not be converted anymore
+        self._heudiconv_worker.check_alive()
         banner_msg("Downloading subject " + subject_to_search)
 
-        # Open log file to write the steps of processing (downloading, renaming...)
-        fp = open(self.log_fn, "a")
+        # Buffer the steps of processing (downloading, renaming...), written at once in the log file
+        # so that the logs of subjects downloaded concurrently do not interleave
+        fp = io.StringIO()
 
         # Real Shanoir2Bids mapping (handle case when solr search term are included)
         bids_mapping = []
+        # DICOM files extracted from the downloaded archives, given to heudiconv
+        dicom_paths = []
 
         # Manual temporary directories containing dowloaded DICOM.zip and extracted files
         # (temporary directories that can be kept are not supported by pythn <3.1
@@ -543,171 +880,152 @@ class DownloadShanoirDatasetToBIDS:
         tmp_archive = Path(self.dl_dir).joinpath(
             "tmp_archived_dicoms", subject_to_search
         )
-        create_tmp_directory(tmp_archive)
-        create_tmp_directory(tmp_dicom)
-
-        # BIDS subject id (search and replace)
-        bids_subject_id = subject_to_search
-        for far in self.list_fars:
-            bids_subject_id = bids_subject_id.replace(far[K_FIND], far[K_REPLACE])
-
-        bids_seq_session = None
-
-        # Loop on each sequence defined in the dictionary
-        for seq in range(self.n_seq):
-            # Isolate elements that are called many times
-            shanoir_seq_name = self.shanoir2bids_dict[seq][
-                K_DS_NAME
-            ]  # Shanoir sequence name (OLD)
-            bids_seq_subdir = self.shanoir2bids_dict[seq][
-                K_BIDS_DIR
-            ]  # Sequence BIDS subdirectory name (NEW)
-            bids_seq_name = self.shanoir2bids_dict[seq][
-                K_BIDS_NAME
-            ]  # Sequence BIDS nickname (NEW)
-            if self.longitudinal:
-                bids_seq_session = self.shanoir2bids_dict[seq][
-                    K_BIDS_SES
-                ]  # Sequence BIDS nickname (NEW)
-            else:
-                bids_seq_session = None
+        try:
+            create_tmp_directory(tmp_archive)
+            create_tmp_directory(tmp_dicom)
+            # Base of the extraction directories of the archives
+            tmp_dicom_sep = str(tmp_dicom) + os.sep
 
-            # Print message concerning the sequence that is being downloaded
-            print(
-                "\t-",
-                bids_seq_name,
-                subject_to_search,
-                "[" + str(seq + 1) + "/" + str(self.n_seq) + "]",
-            )
+            # BIDS subject id (search and replace)
+            bids_subject_id = subject_to_search
+            for far in self.list_fars:
+                bids_subject_id = bids_subject_id.replace(far[K_FIND], far[K_REPLACE])
 
-            request_terms = [
-                self.shanoir_study_id,
-                shanoir_seq_name,
-                subject_to_search,
-                self.shanoir_session_id,
-                self.date_from,
-                self.date_to,
-            ]
+            bids_seq_session = None
 
-            def escape_solr_special_characters(s):
-                # List of Solr special characters
-                special_characters = r'\+\-\!\(\)\{\}\[\]\^"~\?:\\'
-                # remove \* from special characters to be able to use wildcards in solr
-                # Add more if needed
-                escape_pattern = re.compile(r'([{}])'.format(special_characters))
-                return escape_pattern.sub(r'\\\1', s)
-
-            escaped_request_terms = {s: escape_solr_special_characters(s) for s in request_terms}
-
-            # Initialize the parser
-            search_txt = (
-                "studyName:"
-                + escaped_request_terms[self.shanoir_study_id].replace(" ", "?")
-                + " AND datasetName:"
-                + escaped_request_terms[shanoir_seq_name].replace(" ", "?")
-                + " AND subjectName:"
-                + escaped_request_terms[subject_to_search].replace(" ", "?")
-                + " AND examinationComment:"
-                + escaped_request_terms[self.shanoir_session_id].replace(" ", "*")
-                + " AND examinationDate:["
-                + self.date_from
-                + " TO "
-                + self.date_to
-                + "]"
+            search_txt, response, search_results, dl_archives = self.search_and_download_subject(
+                subject_to_search, tmp_archive
             )
 
-            print(search_txt)
-
-            args = self.parser.parse_args(
-                [
-                    "-u",
-                    self.shanoir_username,
-                    "-d",
-                    self.shanoir_domaine,
-                    "-of",
-                    str(tmp_archive),
-                    "-em",
-                    "-st",
-                    search_txt,
-                    "-s",
-                    "200",
-                    "-f",
-                    self.shanoir_file_type,
-                    "-so",
-                    "id,ASC",
-                    "-t",
-                    "500",
-                ]
-            )  # Increase time out for heavy files
-
-            config = shanoir_downloader.initialize(args)
-            response = shanoir_downloader.solr_search(config, args)
-
             # From response, process the data
             # Print the number of items found and a list of these items
             if response.status_code == 200:
-                # Invoke shanoir_downloader to download all the data
-                shanoir_downloader.download_search_results(config, args, response)
+                # Group the found datasets by name to dispatch them to the sequences of the dictionary
+                items_by_name = {}
+                for item in search_results:
+                    items_by_name.setdefault(item["datasetName"], []).append(item)
+
+                # Archives matching several sequences are extracted once
+                extracted_ids = set()
+                archives_to_extract = []
+                # Names of the found datasets dispatched to at least one sequence
+                matched_names = set()
+
+                # Loop on each sequence defined in the dictionary
+                for seq in range(self.n_seq):
+                    # Isolate elements that are called many times
+                    shanoir_seq_name = self._ds_names[seq]
+                    bids_seq_subdir = self._bids_dirs[seq]
+                    bids_seq_name = self._bids_names[seq]
+                    if self.longitudinal:
+                        # Only required for longitudinal studies
+                        bids_seq_session = self.shanoir2bids_dict[seq][K_BIDS_SES]
+                    else:
+                        bids_seq_session = None
+
+                    # Print message concerning the sequence that is being processed
+                    print(
+                        "\t-",
+                        bids_seq_name,
+                        subject_to_search,
+                        "[" + str(seq + 1) + "/" + str(self.n_seq) + "]",
+                    )
 
-                if len(response.json()["content"]) == 0:
-                    warn_msg = """WARNING ! The Shanoir request returned 0 result. Make sure the following search text returns 
-a result on the website.
+                    seq_dataset_names = [
+                        dataset_name
+                        for dataset_name in items_by_name
+                        if match_dataset_name(dataset_name, shanoir_seq_name)
+                    ]
+                    matched_names.update(seq_dataset_names)
+                    seq_items = [
+                        item
+                        for dataset_name in seq_dataset_names
+                        for item in items_by_name[dataset_name]
+                    ]
+
+                    if len(seq_items) == 0:
+                        warn_msg = """WARNING ! The Shanoir request returned 0 result for dataset name "{}". Make sure the 
+following search text returns a result on the website.
 Search Text : "{}" \n""".format(
-                        search_txt
-                    )
-                    print(warn_msg)
-                    fp.write(warn_msg)
-                else:
-                    for item in response.json()["content"]:
-                        # Define subject_id
-                        # su_id = item["subjectName"]
-                        # If the user has defined a list of edits to subject names... then do the find and replace
-                        # weird to do it at the dataset level
-
-                        # ID of the subject (sub-*)
-                        # read_bids_subject_id = su_id
-
-                        # correct BIDS mapping of the searched dataset
-                        bids_seq_mapping = {
-                            "datasetName": item["datasetName"],
-                            "bidsDir": bids_seq_subdir,
-                            "bidsName": bids_seq_name,
-                            "bids_subject_id": bids_subject_id,
-                        }
-
-                        if not self.longitudinal:
-                            bids_seq_session = None
-
-                        bids_seq_mapping["bids_session_id"] = bids_seq_session
-
-                        bids_mapping.append(bids_seq_mapping)
-
-                        # Write the information on the data in the log file
-                        fp.write("- datasetId = " + str(item["datasetId"]) + "\n")
-                        fp.write("  -- studyName: " + item["studyName"] + "\n")
-                        fp.write("  -- subjectName: " + item["subjectName"] + "\n")
-                        fp.write("  -- session: " + item["examinationComment"] + "\n")
-                        fp.write("  -- datasetName: " + item["datasetName"] + "\n")
-                        fp.write(
-                            "  -- examinationDate: " + item["examinationDate"] + "\n"
+                            shanoir_seq_name, search_txt
                         )
-                        fp.write("  >> Downloading archive OK\n")
-
-                        # Extract the downloaded archive
-                        dl_archive = glob(opj(tmp_archive, "*" + item["id"] + "*.zip"))[
-                            0
-                        ]
-                        with zipfile.ZipFile(dl_archive, "r") as zip_ref:
-                            extraction_dir = opj(tmp_dicom, item["id"])
-                            zip_ref.extractall(extraction_dir)
-
-                        fp.write(
-                            "  >> Extraction of all files from archive '"
-                            + dl_archive
-                            + " into "
-                            + extraction_dir
-                            + "\n"
+                        print(warn_msg)
+                        fp.write(warn_msg)
+                    else:
+                        for item in seq_items:
+                            # Define subject_id
+                            # su_id = item["subjectName"]
+                            # If the user has defined a list of edits to subject names... then do the find and replace
+                            # weird to do it at the dataset level
+
+                            # ID of the subject (sub-*)
+                            # read_bids_subject_id = su_id
+
+                            # correct BIDS mapping of the searched dataset
+                            bids_seq_mapping = {
+                                "datasetName": item["datasetName"],
+                                "bidsDir": bids_seq_subdir,
+                                "bidsName": bids_seq_name,
+                                "bids_subject_id": bids_subject_id,
+                            }
+
+                            if not self.longitudinal:
+                                bids_seq_session = None
+
+                            bids_seq_mapping["bids_session_id"] = bids_seq_session
+
+                            bids_mapping.append(bids_seq_mapping)
+
+                            if item["id"] in extracted_ids:
+                                continue
+                            extracted_ids.add(item["id"])
+
+                            dl_archive = dl_archives.get(item["datasetId"])
+                            if dl_archive is None:
+                                download_msg = "ERROR : Downloading archive failed"
+                            else:
+                                download_msg = "Downloading archive OK"
+
+                            # Write the information on the data in the log file
+                            fp.write(
+                                f"- datasetId = {item['datasetId']}\n"
+                                f"  -- studyName: {item['studyName']}\n"
+                                f"  -- subjectName: {item['subjectName']}\n"
+                                f"  -- session: {item['examinationComment']}\n"
+                                f"  -- datasetName: {item['datasetName']}\n"
+                                f"  -- examinationDate: {item['examinationDate']}\n"
+                                f"  >> {download_msg}\n"
+                            )
+                            if dl_archive is None:
+                                continue
+
+                            # The downloaded archive is extracted with the others below
+                            extraction_dir = tmp_dicom_sep + item["id"]
+                            archives_to_extract.append((dl_archive, extraction_dir))
+                            fp.write(
+                                f"  >> Extraction of all files from archive '{dl_archive} into {extraction_dir}\n"
+                            )
+
+                # Datasets found by the search but matching no sequence are not converted, report them
+                for dataset_name, items in items_by_name.items():
+                    if dataset_name in matched_names:
+                        continue
+                    for item in items:
+                        warn_msg = (
+                            f"WARNING ! Dataset {item['datasetId']} \"{dataset_name}\" returned by the Shanoir request "
+                            f"matches no dataset name of the configuration file, it is not converted.\n"
                         )
+                        print(warn_msg)
+                        fp.write(warn_msg)
+
+                # Extract the downloaded archives in parallel
+                # As before, only the DICOM files directly inside the extraction directory are converted
+                extracted = extract_archives(archives_to_extract, self._extract_executor)
+                for (_, extraction_dir), extracted_files in zip(archives_to_extract, extracted):
+                    extraction_dir = os.path.normpath(extraction_dir)
+                    dicom_paths.extend(
+                        f for f in extracted_files if f.endswith(DCM) and opd(f) == extraction_dir
+                    )
 
             elif response.status_code == 204:
                 banner_msg("ERROR : No file found!")
@@ -723,24 +1041,19 @@ Search Text : "{}" \n""".format(
                     + "\n"
                 )
 
-        # Launch DICOM to BIDS conversion using heudiconv + heuristic file + dcm2niix options
-        with tempfile.NamedTemporaryFile(
-            mode="r+", encoding="utf-8", dir=self.dl_dir, suffix=".py"
-        ) as heuristic_file:
-            # Generate Heudiconv heuristic file from configuration.json mapping
-            generate_bids_heuristic_file(
-                bids_mapping, heuristic_file.name, output_type=self.output_file_type
-            )
+            # Launch DICOM to BIDS conversion using heudiconv + heuristic file + dcm2niix options
+            # Heudiconv heuristic file generated from configuration.json mapping
+            heuristic_file = self.get_heuristic_file(bids_mapping)
             with tempfile.NamedTemporaryFile(
                 mode="r+", encoding="utf-8", dir=self.dl_dir, suffix=".json"
             ) as dcm2niix_config_file:
                 self.export_dcm2niix_config_options(dcm2niix_config_file.name)
                 workflow_params = {
-                    "files": glob(opj(tmp_dicom, "*", "*.dcm"), recursive=True),
+                    "files": dicom_paths,
                     "outdir": self.dl_dir,
                     "subjs": [bids_subject_id],
                     "converter": "dcm2niix",
-                    "heuristic": heuristic_file.name,
+                    "heuristic": heuristic_file,
                     "bids_options": "--bids",
                     # "with_prov": True,
                     "debug": self.debug_mode,
@@ -755,7 +1068,7 @@ Search Text : "{}" \n""".format(
                 if self.longitudinal and bids_seq_session is not None:
                     workflow_params["session"] = bids_seq_session
                 try:
-                    workflow(**workflow_params)
+                    self._heudiconv_worker.run(workflow_params)
                 except AssertionError:
                     error = (
                         f" \n >> WARNING : No DICOM file available for conversion for subject {subject_to_search} \n "
@@ -763,36 +1076,98 @@ Search Text : "{}" \n""".format(
                     )
                     print(error)
                     fp.write(error)
-                finally:
-                    if not self.debug_mode:
-                        shutil.rmtree(tmp_archive, ignore_errors=True)
-                        shutil.rmtree(tmp_dicom, ignore_errors=True)
-                        # beware of side effects
-                        shutil.rmtree(tmp_archive.parent, ignore_errors=True)
-                        shutil.rmtree(tmp_dicom.parent, ignore_errors=True)
+        finally:
+            if not self.debug_mode:
+                shutil.rmtree(tmp_archive, ignore_errors=True)
+                shutil.rmtree(tmp_dicom, ignore_errors=True)
 
-                    fp.close()
+            # Also written when the subject fails, to keep the steps done so far
+            self.write_log(fp.getvalue())
+            fp.close()
+
+    def get_heuristic_file(self, bids_mapping):
+        """
+        Get the heudiconv heuristic file of a BIDS mapping. The file is generated once for all the subjects
+        sharing the same mapping, and heudiconv imports it once.
+        :param bids_mapping: list of dict, BIDS mapping of the datasets found for a subject
+        :return: str, path to the heuristic file
+        """
+        # Only the dataset names and the BIDS names are used by the heuristic
+        heuristic_mapping = [
+            {K_DS_NAME: ds_name, K_BIDS_DIR: bids_dir, K_BIDS_NAME: bids_name}
+            for ds_name, bids_dir, bids_name in dict.fromkeys(
+                (m[K_DS_NAME], m[K_BIDS_DIR], m[K_BIDS_NAME]) for m in bids_mapping
+            )
+        ]
+        canonical_mapping = json.dumps(
+            [heuristic_mapping, self.output_file_type], sort_keys=True
+        )
+        digest = hashlib.blake2b(
+            canonical_mapping.encode("utf-8"), digest_size=16
+        ).hexdigest()
+        with self._heuristic_lock:
+            if digest not in self._heuristic_files:
+                # heudiconv imports the heuristic by file name, the digest makes it unique for each mapping
+                path_heuristic_file = opj(self._heuristic_dir, "heuristic_" + digest + ".py")
+                generate_bids_heuristic_file(
+                    heuristic_mapping,
+                    path_heuristic_file,
+                    output_type=self.output_file_type,
+                )
+                self._heuristic_files[digest] = path_heuristic_file
+            return self._heuristic_files[digest]
+
+    def download_and_time_subject(self, subject_to_search):
+        t_start_subject = time()
+        self.download_subject(subject_to_search=subject_to_search)
+        dur_min, dur_sec = divmod(int(time() - t_start_subject), 60)
+        end_msg = (
+            "Downloaded dataset for subject "
+            + subject_to_search
+            + " in {}m{}s".format(dur_min, dur_sec)
+        )
+        banner_msg(end_msg)
 
     def download(self):
         """
         Loop over the Shanoir subjects and go download the required datasets
         :return:
         """
-        self.set_log_filename()
         self.configure_parser()  # Configure the shanoir_downloader parser
+        self.set_search_text_template()
         fp = open(self.log_fn, "w")
         if self.shanoir_subjects is not None:
-            for subject_to_search in self.shanoir_subjects:
-                t_start_subject = time()
-                self.download_subject(subject_to_search=subject_to_search)
-                dur_min = int((time() - t_start_subject) // 60)
-                dur_sec = int((time() - t_start_subject) % 60)
-                end_msg = (
-                    "Downloaded dataset for subject "
-                    + subject_to_search
-                    + " in {}m{}s".format(dur_min, dur_sec)
-                )
-                banner_msg(end_msg)
+            # Started before the download threads, heudiconv is imported once for all the subjects
+            self._heudiconv_worker = HeudiconvWorker()
+            self._heudiconv_worker.start()
+            # Shared by all the subjects, so that the extractions never use more threads than CPUs
+            self._extract_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+            try:
+                # Heuristic files are kept for the whole download to be shared by the subjects
+                with tempfile.TemporaryDirectory(dir=self.dl_dir) as heuristic_dir:
+                    self._heuristic_dir = heuristic_dir
+                    self._heuristic_files = {}
+                    # Subjects are downloaded concurrently, heudiconv conversions are run one at a time
+                    with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+                        futures = [
+                            executor.submit(self.download_and_time_subject, subject_to_search)
+                            for subject_to_search in self.shanoir_subjects
+                        ]
+                        try:
+                            for future in as_completed(futures):
+                                future.result()
+                        except BaseException:
+                            # Do not start the remaining subjects when one fails or the user interrupts
+                            for future in futures:
+                                future.cancel()
+                            raise
+            finally:
+                self._heudiconv_worker.stop()
+                self._extract_executor.shutdown()
+                if not self.debug_mode:
+                    # temporary directories are shared by all the subjects
+                    shutil.rmtree(opj(self.dl_dir, "tmp_archived_dicoms"), ignore_errors=True)
+                    shutil.rmtree(opj(self.dl_dir, "tmp_dicoms"), ignore_errors=True)
         else:
             print(f"No Shanoir Subjects to Download")
 
@@ -837,6 +1212,13 @@ def main():
         action="store_true",
         help="Toggle debug mode (keep temporary directories)",
     )
+    parser.add_argument(
+        "-nw",
+        "--n_workers",
+        type=int,
+        default=DEFAULT_N_WORKERS,
+        help="Number of subjects downloaded concurrently.",
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--activate-datalad", action="store_true", dest="datalad", help="Store outputs as datalad dataset")
     group.add_argument("--deactivate-datalad", action="store_false", dest="datalad", help="Store outputs as regular directory")
@@ -861,6 +1243,7 @@ def main():
         stb.debug_mode = True
 
     stb.datalad = args.datalad
+    stb.set_n_workers(args.n_workers)
 
     if args.longitudinal:
         stb.toggle_longitudinal_version()
@@ -7,6 +7,7 @@ import re
 import sys
 import argparse
 import logging
+import threading
 import http.client as http_client
 from http.client import responses
 from pathlib import Path
@@ -79,7 +80,7 @@ def init_logging(args):
 		requests_log.propagate = True
 
 
-def initialize(args):
+def initialize(args, session=None):
 
 	server_domain = args.domain
 	username = args.username
@@ -140,11 +141,19 @@ def initialize(args):
 			# 'https': 'https://' + proxy_url,
 		}
 	
-	return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout }
+	return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout, 'session': session }
+
+# the requests session given to initialize (to reuse the connections between requests), or the requests module
+def get_session(config):
+	return config.get('session') or requests
 
 
 access_token = None
 refresh_token = None
+# tokens are shared module-wide, avoid asking the password several times when requests run in threads
+token_lock = threading.Lock()
+# exit code of a failed authentication, the threads waiting for the token exit without asking the password again
+access_token_exit_code = None
 
 # using user's password, get the first access token and the refresh token
 def ask_access_token(config):
@@ -164,7 +173,7 @@ def ask_access_token(config):
 
 	headers = {'content-type': 'application/x-www-form-urlencoded'}
 	print('get keycloak token...', end=' ')
-	response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
+	response = get_session(config).post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
 	if not hasattr(response, 'status_code') or response.status_code != 200:
 		print('Failed to connect, make sur you have a certified IP or are connected on a valid VPN.')
 		sys.exit(1)
@@ -203,6 +212,7 @@ try:
 			for data in response.iter_content(chunk_size=1024):
 				size = file.write(data)
 				bar.update(size)
+		return filename
 
 except ImportError as e:
 
@@ -210,7 +220,7 @@ except ImportError as e:
 		filename = get_filename_from_response(output_folder, response)
 		if not filename: return
 		open(filename, 'wb').write(response.content)
-		return
+		return filename
 
 # get a new acess token using the refresh token
 def refresh_access_token(config):
@@ -222,7 +232,7 @@ def refresh_access_token(config):
 	}
 	headers = {'content-type': 'application/x-www-form-urlencoded'}
 	print('refresh keycloak token...')
-	response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
+	response = get_session(config).post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
 	if response.status_code != 200:
 		logging.error(f'response status : {response.status_code}, {responses[response.status_code]}')
 	response_json = response.json()
@@ -230,10 +240,11 @@ def refresh_access_token(config):
 
 def perform_rest_request(config, rtype, url, **kwargs):
 	response = None
+	session = get_session(config)
 	if rtype == 'get':
-		response = requests.get(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
+		response = session.get(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
 	elif rtype == 'post':
-		response = requests.post(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
+		response = session.post(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
 	else:
 		print('Error: unimplemented request type')
 
@@ -242,18 +253,30 @@ def perform_rest_request(config, rtype, url, **kwargs):
 
 # perform a request on the given url, asks for a new access token if the current one is outdated
 def rest_request(config, rtype, url, raise_for_status=True, **kwargs):
-	global access_token
-	if access_token is None:
-		access_token = ask_access_token(config)
+	global access_token, access_token_exit_code
+	with token_lock:
+		if access_token_exit_code is not None:
+			sys.exit(access_token_exit_code)
+		if access_token is None:
+			try:
+				access_token = ask_access_token(config)
+			except SystemExit as e:
+				access_token_exit_code = e.code
+				raise
+		token = access_token
 	headers = { 
-		'Authorization' : 'Bearer ' + access_token,
+		'Authorization' : 'Bearer ' + token,
 		'content-type' : 'application/json'
 	}
 	response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
 	# if token is outdated, refresh it and try again
 	if response.status_code == 401:
-		access_token = refresh_access_token(config)
-		headers['Authorization'] = 'Bearer ' + access_token
+		with token_lock:
+			# refresh only once, other threads reuse the token refreshed by the first one
+			if access_token == token:
+				access_token = refresh_access_token(config)
+			token = access_token
+		headers['Authorization'] = 'Bearer ' + token
 		response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
 	if raise_for_status:
 		response.raise_for_status()
@@ -296,8 +319,7 @@ def download_dataset(config, dataset_id, file_format, silent=False):
 	file_format = 'nii' if file_format == 'nifti' else 'dcm'
 	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
 	response = rest_get(config, url, params={ 'format': file_format })
-	download_file(config['output_folder'], response)
-	return
+	return download_file(config['output_folder'], response)
 
 def download_datasets(config, dataset_ids, file_format):
 	if len(dataset_ids) > 50:
@@ -433,20 +455,24 @@ def solr_search(config, args):
 
 	return response
 	
-def download_search_results(config, args, response):
+# download the datasets found by solr_search, returns the paths of the downloaded files by dataset id
+# json_content can be given to avoid decoding the response again when it has already been done
+def download_search_results(config, args, response, json_content=None):
 
+	filenames = {}
 	if response.status_code == 200:
-		json_content = response.json()['content']
+		if json_content is None:
+			json_content = response.json()['content']
 		for item in json_content:
 			try:
-				download_dataset(config, item['datasetId'], args.format, False)
+				filenames[item['datasetId']] = download_dataset(config, item['datasetId'], args.format, False)
 			except requests.HTTPError as e:
 				log_response(e)
 			except requests.RequestException as e:
 				logging.error(str(e))
 			except Exception as e:
 				logging.error(str(e))
-	return
+	return filenames
 
 
 if __name__ == '__main__':